@@ -1,13 +1,18 @@
 import requests
+import csv
 import json
 import time
 import os
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import random
+import hashlib
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from tqdm import tqdm
 import threading
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
 # 锁用于控制API请求速率
 rate_limit_lock = threading.Lock()
@@ -15,11 +20,301 @@ requests_per_interval = 200
 interval_seconds = 300
 requests_made = 10
 interval_start_time = time.time()
+requests_sent = 0  # 本次运行发出的请求总数，供调度器估算请求速率
 
-# 安全请求函数，用于处理VNDB API的请求
-def saferequestvndb(proxy, method, url, json=None, headers=None):
-    global requests_made, interval_start_time
+# 下载 VNDB 列表的分页设置
+ulist_page_size = 100
+ulist_workers = 4
+
+# 映射表每新增多少条写一次文件，同步结束时再写一次
+mapping_save_every = 50
+# 进度每同步多少条写一次文件，同步结束时再写一次
+progress_save_every = 20
+
+# 重试设置：指数退避加随机抖动，优先遵循 Retry-After
+retry_status_codes = {429, 500, 502, 503, 504}
+max_attempts = 6
+backoff_base = 1
+backoff_cap = 60
+request_timeout = 30  # 单次HTTP请求的超时时间
+request_budget_seconds = 180  # 单个请求（含所有重试）的时间预算
+run_budget_seconds = float(os.getenv("RUN_BUDGET_SECONDS", "0"))  # 整次运行的时间预算，0 表示不限制
+run_start_time = time.time()
+
+# 追踪器：按条目记录搜索、限速等待、重试和上传的耗时，导出为 Chrome trace-event/Perfetto JSON
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.entries = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.start = time.perf_counter()
+
+    def now(self):
+        return time.perf_counter()
+
+    # 记录一个已完成的区间，归入当前线程正在处理的条目
+    def record(self, name, cat, start, end, **args):
+        if not self.enabled:
+            return
+        self.add_event(name, cat, start, end, end - start, args)
+
+    # self_time 为扣除嵌套子区间后的耗时，条目的分类耗时按它累计，各分类之间不重叠
+    def add_event(self, name, cat, start, end, self_time, args):
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1] += end - start
+        entry = getattr(self.local, "entry", None)
+        if entry is not None:
+            args["entry"] = entry["title"]
+            entry["counts"][cat] = entry["counts"].get(cat, 0) + 1
+            entry["seconds"][cat] = entry["seconds"].get(cat, 0) + self_time
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": round((start - self.start) * 1e6),
+            "dur": round((end - start) * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        if not self.enabled:
+            yield
+            return
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        self.local.stack.append(0.0)
+        start = self.now()
+        try:
+            yield
+        finally:
+            end = self.now()
+            children = self.local.stack.pop()
+            self.add_event(name, cat, start, end, end - start - children, args)
+
+    # 标记当前线程正在处理的条目，期间的所有区间都归到该条目下
+    @contextmanager
+    def entry(self, title):
+        if not self.enabled:
+            yield
+            return
+        entry = {"title": title, "counts": {}, "seconds": {}}
+        self.local.entry = entry
+        start = self.now()
+        try:
+            yield
+        finally:
+            end = self.now()
+            self.local.entry = None
+            entry["duration"] = end - start
+            self.record(title, "entry", start, end)
+            with self.lock:
+                self.entries.append(entry)
+
+    # 最慢的条目和搜索次数最多的标题
+    def summary(self, top=10):
+        slowest = sorted(self.entries, key=lambda e: e["duration"], reverse=True)[:top]
+        most_searched = sorted(self.entries, key=lambda e: e["counts"].get("search", 0), reverse=True)[:top]
+        return {
+            "slowest_entries": [
+                {"title": e["title"], "seconds": round(e["duration"], 3),
+                 "breakdown": {cat: round(sec, 3) for cat, sec in e["seconds"].items()}}
+                for e in slowest
+            ],
+            "most_searches": [
+                {"title": e["title"], "searches": e["counts"].get("search", 0)}
+                for e in most_searched if e["counts"].get("search", 0)
+            ]
+        }
+
+    # 记录随时间变化的数值，在 Perfetto 中显示为计数器轨道
+    def counter(self, name, value):
+        if not self.enabled:
+            return
+        event = {"name": name, "ph": "C", "ts": round((self.now() - self.start) * 1e6), "pid": os.getpid(), "args": {name: value}}
+        with self.lock:
+            self.events.append(event)
+
+    def save(self, path, top=10):
+        summary = self.summary(top)
+        with self.lock:
+            data = {"traceEvents": list(self.events), "displayTimeUnit": "ms", "otherData": summary}
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        print(f"追踪数据保存到: {path}")
+        print("最慢的条目:")
+        for e in summary["slowest_entries"]:
+            print(f"  {e['seconds']:.2f}s  {e['title']}  {e['breakdown']}")
+        print("搜索次数最多的标题:")
+        for e in summary["most_searches"]:
+            print(f"  {e['searches']}  {e['title']}")
+
+tracer = Tracer()
+
+# 超出时间预算时抛出的异常
+class RetryBudgetExceeded(Exception):
+    pass
+
+# 本次运行的时间预算耗尽，与单个请求超出预算不同，条目不算失败，留待下次运行
+class RunBudgetExceeded(RetryBudgetExceeded):
+    pass
+
+# 按截止时间的来源选择异常类型：截止时间就是运行截止时间时表示运行预算耗尽
+def budget_exceeded(message, deadline=None):
+    if run_deadline() is not None and (deadline is None or deadline >= run_deadline()):
+        return RunBudgetExceeded(message)
+    return RetryBudgetExceeded(message)
+
+# 熔断器：连续失败过多时暂停所有线程，冷却后只放行一个探测请求
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30, max_cooldown=600):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+        self.probing = False
+        self.condition = threading.Condition()
+
+    # 请求前调用，熔断打开时阻塞直到冷却结束或超出截止时间；返回本次请求是否为半开探测
+    def before_request(self, deadline=None):
+        with self.condition:
+            while True:
+                now = time.time()
+                if now >= self.open_until and self.failures < self.failure_threshold:
+                    return False
+                if now >= self.open_until and not self.probing:
+                    self.probing = True
+                    return True
+                wait = self.open_until - now if now < self.open_until else 1
+                if deadline is not None and now + wait > deadline:
+                    raise budget_exceeded("熔断器打开，等待会超出时间预算", deadline)
+                self.condition.wait(wait)
+
+    def record_success(self):
+        with self.condition:
+            self.failures = 0
+            self.trips = 0
+            self.probing = False
+            self.condition.notify_all()
+
+    def record_failure(self):
+        with self.condition:
+            now = time.time()
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold and now >= self.open_until:
+                self.trips += 1
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** (self.trips - 1))
+                self.open_until = now + cooldown
+                print(f"连续失败 {self.failures} 次，熔断 {cooldown:.0f} 秒，暂停所有请求.")
+            self.condition.notify_all()
+
+    # 探测请求因时间预算中止时，既不算成功也不算失败，只交还探测名额
+    def release_probe(self):
+        with self.condition:
+            self.probing = False
+            self.condition.notify_all()
+
+    # 服务端要求等待（Retry-After）时让所有线程一起暂停
+    def pause(self, seconds):
+        with self.condition:
+            self.open_until = max(self.open_until, time.time() + seconds)
+            self.condition.notify_all()
+
+circuit_breaker = CircuitBreaker()
+
+# 解析 Retry-After 头，支持秒数和HTTP日期两种格式
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# 整次运行的截止时间，未设置预算时返回 None
+def run_deadline():
+    if run_budget_seconds > 0:
+        return run_start_time + run_budget_seconds
+    return None
+
+# 统一的重试层：send(timeout, deadline) 发送一次请求并返回响应，等待不能超过 deadline
+def request_with_retry(send, breaker=circuit_breaker, description=""):
+    deadline = time.time() + request_budget_seconds
+    run_limited = run_deadline() is not None and run_deadline() <= deadline
+    if run_limited:
+        deadline = run_deadline()
+        if time.time() >= deadline:
+            raise RunBudgetExceeded("已超出本次运行的时间预算")
+
+    attempt = 0
+    while True:
+        wait_start = tracer.now()
+        probe = breaker.before_request(deadline)
+        if tracer.now() - wait_start > 0.001:
+            tracer.record("breaker_wait", "breaker", wait_start, tracer.now())
+        attempt += 1
+        resp, error = None, None
+        try:
+            resp = send(max(1, min(request_timeout, deadline - time.time())), deadline)
+        except requests.exceptions.RequestException as e:
+            error = e
+        except RetryBudgetExceeded:
+            # 请求还没发出就因时间预算中止，不是服务端的问题，不计入熔断
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
 
+        if resp is not None and resp.status_code not in retry_status_codes:
+            breaker.record_success()
+            return resp
+        breaker.record_failure()
+
+        retry_after = parse_retry_after(resp.headers.get("Retry-After")) if resp is not None else None
+        if retry_after is not None:
+            delay = retry_after
+            breaker.pause(retry_after)
+        else:
+            delay = random.uniform(0, min(backoff_cap, backoff_base * 2 ** (attempt - 1)))
+
+        reason = f"HTTP {resp.status_code}" if resp is not None else f"{type(error).__name__}: {error}"
+        if run_limited and attempt < max_attempts and time.time() + delay > deadline:
+            raise RunBudgetExceeded(f"重试 {description} 会超出本次运行的时间预算")
+        if attempt >= max_attempts or time.time() + delay > deadline:
+            print(f"放弃请求 {description}（{reason}），已尝试 {attempt} 次.")
+            if resp is not None:
+                return resp
+            raise error
+        print(f"请求失败 {description}（{reason}），{delay:.1f} 秒后进行第 {attempt + 1} 次尝试.")
+        with tracer.span("retry_backoff", "retry", attempt=attempt, reason=reason):
+            time.sleep(delay)
+
+# 等待速率限制配额，需要等到本次运行的截止时间之后时直接放弃
+# 单个请求的时间预算只约束重试和退避，不约束这里：速率窗口可能比它更长
+def wait_for_rate_limit(deadline=None):
+    global requests_made, interval_start_time, requests_sent
+
+    wait_start = tracer.now()
     with rate_limit_lock:
         current_time = time.time()
         if current_time - interval_start_time >= interval_seconds:
@@ -28,6 +323,8 @@ def saferequestvndb(proxy, method, url, json=None, headers=None):
 
         if requests_made >= requests_per_interval:
             time_to_wait = interval_seconds - (current_time - interval_start_time)
+            if time_to_wait > 0 and deadline is not None and current_time + time_to_wait > deadline:
+                raise RunBudgetExceeded("等待速率限制配额会超出本次运行的时间预算")
             if time_to_wait > 0:
                 print(f"Rate limit reached, sleeping for {time_to_wait:.2f} seconds.")
                 time.sleep(time_to_wait)
@@ -35,40 +332,185 @@ def saferequestvndb(proxy, method, url, json=None, headers=None):
             requests_made = 0
 
         requests_made += 1
+        requests_sent += 1
 
-    session = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    if tracer.now() - wait_start > 0.001:
+        tracer.record("rate_limit_wait", "rate_limit", wait_start, tracer.now())
 
-    try:
-        resp = session.request(
-            method,
-            "https://api.vndb.org/kana/" + url,
-            headers=headers,
-            json=json,
-            proxies=proxy,
-        )
-        if resp.status_code == 429:
-            time.sleep(3)
-            return saferequestvndb(proxy, method, url, json, headers)
-        elif resp.status_code == 400:
-            print(resp.text)
-        else:
-            if method.upper() in ["GET", "POST"]:
-                try:
-                    return resp.json()
-                except:
-                    print(resp.status_code)
-                    print(resp.text)
-                    return None
-    except requests.exceptions.SSLError as e:
-        print(f"SSL Error: {e}")
-        time.sleep(5)
-        return saferequestvndb(proxy, method, url, json, headers)
+# AIMD 并发控制：请求顺利时每轮加一，出现 429、错误或延迟明显升高时减半
+# acquire/release 供线程池使用，异步引擎可以用 try_acquire 轮询，observe 与具体的并发方式无关
+class ConcurrencyController:
+    def __init__(self, initial=2, minimum=1, maximum=16, latency_factor=3):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.latency = None  # 成功请求延迟的指数滑动平均
+        self.last_decrease = 0
+        self.start_time = time.time()
+        self.history = [(0.0, int(self.limit))]
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    # 等待空闲的并发名额，等到 deadline 仍没有名额时放弃
+    def acquire(self, deadline=None):
+        wait_start = tracer.now()
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                timeout = None if deadline is None else deadline - time.time()
+                if timeout is not None and timeout <= 0:
+                    raise budget_exceeded("等待并发名额超出时间预算", deadline)
+                self.condition.wait(timeout)
+            self.in_flight += 1
+        if tracer.now() - wait_start > 0.001:
+            tracer.record("concurrency_wait", "concurrency", wait_start, tracer.now())
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    # 根据一次请求的结果调整并发上限，status 为 None 表示连接错误
+    def observe(self, latency, status):
+        with self.condition:
+            now = time.time()
+            failed = status is None or status == 429 or status >= 500
+            slow = self.latency is not None and latency > self.latency_factor * self.latency
+            if failed or slow:
+                # 一个往返时间内的多次失败只减半一次
+                if now - self.last_decrease > (self.latency or 0):
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+            elif requests_made < requests_per_interval:
+                # 速率限制的配额用完时再增加并发也没有意义
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if not failed:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if int(self.limit) != self.history[-1][1]:
+                self.history.append((now - self.start_time, int(self.limit)))
+                tracer.counter("concurrency", int(self.limit))
+            self.condition.notify_all()
+
+    def report(self):
+        limits = [limit for _, limit in self.history]
+        print(f"并发上限: 最终 {int(self.limit)}，最小 {min(limits)}，最大 {max(limits)}，调整 {len(self.history) - 1} 次")
+        for elapsed, limit in self.history[-20:]:
+            print(f"  {elapsed:8.1f}s  {limit}")
+
+concurrency = ConcurrencyController()
+
+# 所有线程共用的连接池，重试由 request_with_retry 统一处理
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=concurrency.maximum, max_retries=0))
+
+# 安全请求函数，用于处理VNDB API的请求
+def saferequestvndb(proxy, method, url, json=None, headers=None):
+    def send(timeout, deadline):
+        wait_for_rate_limit(run_deadline())
+        concurrency.acquire(deadline)
+        start = time.time()
+        try:
+            with tracer.span(f"{method} {url}", "http"):
+                resp = session.request(
+                    method,
+                    "https://api.vndb.org/kana/" + url,
+                    headers=headers,
+                    json=json,
+                    proxies=proxy,
+                    timeout=timeout,
+                )
+        except requests.exceptions.RequestException:
+            concurrency.observe(time.time() - start, None)
+            raise
+        finally:
+            concurrency.release()
+        concurrency.observe(time.time() - start, resp.status_code)
+        return resp
+
+    resp = request_with_retry(send, description=f"{method} {url}")
+    # 重试用尽仍失败，或上传没有成功时抛出异常，由调用方记录为失败
+    if resp.status_code in retry_status_codes or (method.upper() == "PATCH" and not 200 <= resp.status_code < 300):
+        print(resp.status_code)
+        print(resp.text)
+        raise requests.exceptions.HTTPError(f"{method} {url} 失败: HTTP {resp.status_code}", response=resp)
+    elif resp.status_code == 400:
+        print(resp.text)
+    else:
+        if method.upper() in ["GET", "POST"]:
+            try:
+                return resp.json()
+            except:
+                print(resp.status_code)
+                print(resp.text)
+                return None
+
+# 合并相同的搜索请求：同时发出的相同请求只发送一次，其余等待第一个的结果；已完成的结果保存在本次运行的 LRU 缓存中
+class RequestCoalescer:
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "cache_hits": 0, "coalesced": 0}
+
+    @staticmethod
+    def make_key(url, body):
+        return url, json.dumps(body, sort_keys=True, ensure_ascii=False)
+
+    # fetch 为真正发送请求的函数，返回 None 表示失败，失败的结果不缓存
+    def get(self, key, fetch):
+        with self.lock:
+            self.stats["requests"] += 1
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return self.cache[key]
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = {"event": threading.Event(), "result": None, "error": None}
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fetch()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                if call["result"] is not None:
+                    self.cache[key] = call["result"]
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+            call["event"].set()
+        return call["result"]
+
+    def report(self):
+        saved = self.stats["cache_hits"] + self.stats["coalesced"]
+        print(f"搜索请求 {self.stats['requests']} 次，缓存命中 {self.stats['cache_hits']} 次，合并 {self.stats['coalesced']} 次，共节省 {saved} 次请求")
+
+search_coalescer = RequestCoalescer()
 
 # 安全获取VNDB JSON数据的函数
 def safegetvndbjson(proxy, url, json):
-    return saferequestvndb(proxy, "POST", url, json)
+    with tracer.span(f"search {url}", "search", query=json.get("filters")):
+        key = RequestCoalescer.make_key(url, json)
+        return search_coalescer.get(key, lambda: saferequestvndb(proxy, "POST", url, json))
 
 # 截断标题的函数，用于处理标题中的特殊字符
 def truncate_title(title):
@@ -106,40 +548,326 @@ def getidbytitle_(proxy, title, title_cn):
         vid = getvidbytitle_vn(proxy, title_cn)
     return vid
 
+# 条目在同步记录中的键，优先使用 Bangumi subject_id
+def game_key(game):
+    title, subject_id = game[0], game[5]
+    return f"subject:{subject_id}" if subject_id is not None else f"title:{title}"
+
+# 失败记录中的条目还原为游戏数据元组
+def failed_entry_to_game(entry):
+    return (entry["title"], entry["title_cn"], entry["labels_set"], entry["vote"], entry["finished"], entry.get("subject_id"))
+
+# 按条目键的哈希把条目稳定地分到 shard_count 个分片之一
+def shard_of(game, shard_count):
+    return int(hashlib.sha1(game_key(game).encode('utf-8')).hexdigest(), 16) % shard_count
+
+def select_shard(game_data, shard_index, shard_count):
+    return [game for game in game_data if shard_of(game, shard_count) == shard_index]
+
+# 分片使用的文件名，例如 progress.json -> progress.shard0of4.json
+def shard_path(path, shard_index, shard_count):
+    if shard_count <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_index}of{shard_count}{ext}"
+
+# 条目需要同步到 VNDB 的内容，变化时需要重新同步
+def game_fingerprint(game):
+    return json.dumps([game[2], game[3], game[4]])
+
+# 按优先级和时间预算调度同步任务：从未同步 > 上次同步后有变化 > 以相同内容失败过，同级内最近更新的优先
+class SyncScheduler:
+    def __init__(self, deadline=None, safety_margin=120, requests_per_entry=2):
+        self.deadline = deadline
+        self.safety_margin = safety_margin
+        self.default_requests_per_entry = requests_per_entry
+        self.start_time = time.time()
+        self.start_requests = requests_sent
+        self.entries_done = 0
+
+    # 返回按优先级排序的待同步条目和未变化而跳过的条目数
+    @staticmethod
+    def prioritize(game_data, synced, failed):
+        queue = []
+        skipped = 0
+        for game in game_data:
+            key = game_key(game)
+            fingerprint = game_fingerprint(game)
+            if synced.get(key) == fingerprint:
+                skipped += 1
+                continue
+            # 失败后内容又有变化的条目按正常优先级处理
+            if failed.get(key) == fingerprint:
+                tier = 2
+            elif key in synced:
+                tier = 1
+            else:
+                tier = 0
+            queue.append((tier, game))
+        queue.sort(key=lambda item: item[1][4] or "", reverse=True)
+        queue.sort(key=lambda item: item[0])
+        return [game for _, game in queue], skipped
+
+    def entry_done(self):
+        self.entries_done += 1
+
+    # 观测到的请求速率，样本太少时按速率限制估算
+    def request_rate(self):
+        elapsed = time.time() - self.start_time
+        made = requests_sent - self.start_requests
+        if elapsed >= 30 and made >= 10:
+            return made / elapsed
+        return requests_per_interval / interval_seconds
+
+    def requests_per_entry(self):
+        if self.entries_done >= 5:
+            return max(1, (requests_sent - self.start_requests) / self.entries_done)
+        return self.default_requests_per_entry
+
+    # 预计在截止时间前还能完成的条目数，未设置预算时返回 None
+    def predicted_capacity(self):
+        if self.deadline is None:
+            return None
+        remaining = self.deadline - self.safety_margin - time.time()
+        return max(0, int(remaining * self.request_rate() / self.requests_per_entry()))
+
+    # in_flight 个条目仍在进行时，是否还能开始一个新的条目
+    def should_continue(self, in_flight):
+        capacity = self.predicted_capacity()
+        return capacity is None or capacity > in_flight
+
+# Bangumi subject_id 到 VNDB ID 的映射表，命中时无需按标题搜索
+class SubjectMapping:
+    # base_path 为分片运行时共享的映射表，只读取不写入
+    def __init__(self, path, base_path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mapping = {}
+        self.hits = 0
+        self.unsaved = 0
+        for file_path in (base_path, path):
+            if file_path and os.path.exists(file_path):
+                with open(file_path, 'r', encoding='utf-8') as file:
+                    self.mapping.update(json.load(file))
+
+    @staticmethod
+    def normalize(subject_id, vid):
+        vid = str(vid).strip()
+        if not vid:
+            return None, None
+        if not vid.startswith("v"):
+            vid = "v" + vid
+        return str(subject_id).strip(), vid
+
+    def get(self, subject_id):
+        if subject_id is None:
+            return None
+        vid = self.mapping.get(str(subject_id))
+        if vid:
+            with self.lock:
+                self.hits += 1
+        return vid
+
+    # 记录一次确认的匹配结果，攒够 mapping_save_every 条变化再写回文件
+    def add(self, subject_id, vid):
+        if subject_id is None:
+            return
+        subject_id, vid = self.normalize(subject_id, vid)
+        with self.lock:
+            if self.mapping.get(subject_id) == vid:
+                return
+            self.mapping[subject_id] = vid
+            self.unsaved += 1
+            if self.unsaved >= mapping_save_every:
+                self.save()
+
+    # 写回尚未保存的变化
+    def flush(self):
+        with self.lock:
+            if self.unsaved:
+                self.save()
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump(self.mapping, file, ensure_ascii=False, indent=4, sort_keys=True)
+        self.unsaved = 0
+
+    # 批量导入映射，支持 CSV（subject_id,vndb_id 两列）和 JSON（字典或对象列表），导入的条目覆盖已有条目
+    def import_file(self, file_path):
+        pairs = []
+        if file_path.endswith(".csv"):
+            with open(file_path, 'r', encoding='utf-8') as file:
+                for row in csv.reader(file):
+                    if len(row) >= 2 and row[0].strip().isdigit():
+                        pairs.append((row[0], row[1]))
+        else:
+            with open(file_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            if isinstance(data, dict) and "data" in data:
+                data = data["data"]
+            if isinstance(data, dict):
+                pairs = list(data.items())
+            else:
+                pairs = [(item["subject_id"], item.get("vndb_id") or item.get("vid")) for item in data]
+
+        count = 0
+        with self.lock:
+            for subject_id, vid in pairs:
+                if subject_id is None or vid is None:
+                    continue
+                subject_id, vid = self.normalize(subject_id, vid)
+                if vid:
+                    self.mapping[subject_id] = vid
+                    count += 1
+            self.save()
+        print(f"从 {file_path} 导入了 {count} 条映射")
+        return count
+
 # VNDB同步类
 class VNDBSync:
     def __init__(self, config_path=None, proxy=None):
         self.config = {
             "Token": os.getenv("VNDB_TOKEN"),
             "sync_local": os.getenv("SYNC_LOCAL", "false").lower() == "true",
-            "download_vndb": os.getenv("DOWNLOAD_VNDB", "false").lower() == "true"
+            "download_vndb": os.getenv("DOWNLOAD_VNDB", "false").lower() == "true",
+            "incremental_download": os.getenv("INCREMENTAL_DOWNLOAD", "false").lower() == "true",
+            "trace_file": os.getenv("TRACE_FILE"),
+            "mapping_import": [p for p in os.getenv("MAPPING_IMPORT", "").split(os.pathsep) if p],
+            "shard_index": int(os.getenv("SHARD_INDEX", "0")),
+            "shard_count": int(os.getenv("SHARD_COUNT", "1"))
         }
         self.proxy = proxy
         self.headers = {"Authorization": f"Token {self.config['Token']}"}
         self.sync_local = self.config.get("sync_local", False)
         self.download_vndb = self.config.get("download_vndb", False)
-        self.progress_file = os.path.join(os.path.dirname(__file__), "progress.json")
-        self.failed_uploads_path = os.path.join(os.path.dirname(__file__), "failed_uploads.json")
-        self.current_index = self.load_progress()
+        self.incremental_download = self.config.get("incremental_download", False)
+        self.trace_file = self.config.get("trace_file")
+        self.shard_index = self.config.get("shard_index", 0)
+        self.shard_count = self.config.get("shard_count", 1)
+        if not 0 <= self.shard_index < self.shard_count:
+            raise ValueError(f"分片序号 {self.shard_index} 超出范围，分片数为 {self.shard_count}")
+        # 分片运行时各自写入独立的进度和失败记录文件，合并前的共享文件只作为初始状态读取
+        self.base_progress_file = os.path.join(os.path.dirname(__file__), "progress.json")
+        self.base_failed_uploads_path = os.path.join(os.path.dirname(__file__), "failed_uploads.json")
+        self.progress_file = shard_path(self.base_progress_file, self.shard_index, self.shard_count)
+        self.failed_uploads_path = shard_path(self.base_failed_uploads_path, self.shard_index, self.shard_count)
+        self.ulist_snapshot_path = os.path.join(os.path.dirname(__file__), "vndb_ulist_snapshot.json")
+        self._userid = None
+        base_mapping_path = os.path.join(os.path.dirname(__file__), "subject_mapping.json")
+        self.mapping = SubjectMapping(shard_path(base_mapping_path, self.shard_index, self.shard_count), base_mapping_path)
+        for mapping_path in self.config.get("mapping_import", []):
+            self.mapping.import_file(mapping_path)
+        self.file_lock = threading.Lock()
+        self.base_synced = self.read_synced(self.base_progress_file) if self.shard_count > 1 else {}
+        self.synced = self.load_progress()
+        self.unsaved_progress = 0
+        # 本分片的失败记录只读取一次，之后在内存中维护
+        self.failed = self.read_failed_uploads(self.failed_uploads_path)
+        self.failed_changed = False
 
 
     @property
     def userid(self):
-        return saferequestvndb(self.proxy, "GET", "authinfo", headers=self.headers)["id"]
+        if self._userid is None:
+            self._userid = saferequestvndb(self.proxy, "GET", "authinfo", headers=self.headers)["id"]
+        return self._userid
 
-    # 查询用户列表
-    def querylist(self, title):
-        userid = self.userid
+    # 查询用户列表，incremental 为 True 时只下载上次快照之后修改过的条目并与快照合并
+    def querylist(self, title, incremental=False):
+        fields = "id, lastmod, vn.title,vn.titles.title,vn.titles.main" if title else "id, lastmod"
+        snapshot = self.load_ulist_snapshot()
+        usable = snapshot is not None and snapshot["userid"] == self.userid and snapshot["fields"] == fields
+
+        if incremental and usable:
+            collectresults = self.query_ulist_since(fields, snapshot["high_water"])
+            print(f"增量下载了 {len(collectresults)} 条修改过的条目")
+            items = dict(snapshot["items"])
+            items.update({item["id"]: item for item in collectresults})
+            collectresults = list(items.values())
+        else:
+            collectresults = self.query_ulist_pages(fields)
+
+        if usable:
+            diff = self.diff_ulist(snapshot["items"], collectresults)
+            print(f"与上次快照相比: 新增 {len(diff['added'])}，修改 {len(diff['changed'])}，删除 {len(diff['removed'])}")
+        self.save_ulist_snapshot(fields, collectresults)
+        return collectresults
+
+    def query_ulist_page(self, fields, page, sort="id", reverse=False, count=False):
+        json_data = {"user": self.userid, "fields": fields, "sort": sort, "reverse": reverse, "results": ulist_page_size, "page": page}
+        if count:
+            json_data["count"] = True
+        return saferequestvndb(self.proxy, "POST", "ulist", json=json_data, headers=self.headers)
+
+    # 完整下载：第一页拿到总数后并发下载剩余页
+    # 按唯一的 id 排序保证分页稳定，下载期间列表有变化导致的重复条目按 id 去重
+    def query_ulist_pages(self, fields):
+        response = self.query_ulist_page(fields, 1, count=True)
+        collectresults = response["results"]
+        if not response["more"]:
+            return collectresults
+
+        pages = -(-response["count"] // ulist_page_size)
+        with ThreadPoolExecutor(max_workers=ulist_workers) as executor:
+            for response in executor.map(lambda page: self.query_ulist_page(fields, page), range(2, pages + 1)):
+                collectresults += response["results"]
+
+        # 下载期间列表变长时，顺序补齐剩余页
+        while response["more"]:
+            pages += 1
+            response = self.query_ulist_page(fields, pages)
+            collectresults += response["results"]
+        return self.dedupe_ulist(collectresults)
+
+    # 增量下载：按 lastmod 倒序翻页，遇到早于上次快照高水位的条目即停止
+    def query_ulist_since(self, fields, high_water):
         pagei = 1
         collectresults = []
         while True:
-            json_data = {"user": userid, "fields": ("id, vn.title,vn.titles.title,vn.titles.main" if title else "id"), "sort": "vote", "results": 100, "page": pagei}
+            response = self.query_ulist_page(fields, pagei, sort="lastmod", reverse=True)
             pagei += 1
-            response = saferequestvndb(self.proxy, "POST", "ulist", json=json_data, headers=self.headers)
-            collectresults += response["results"]
-            if not response["more"]:
+            changed = [item for item in response["results"] if item["lastmod"] >= high_water]
+            collectresults += changed
+            if not response["more"] or len(changed) < len(response["results"]):
                 break
-        return collectresults
+        # 翻页期间有条目被修改时会移到最前，其余条目后移，下一页可能再次出现已下载的条目
+        return self.dedupe_ulist(collectresults)
+
+    # 按条目ID去重，保留先出现的条目
+    @staticmethod
+    def dedupe_ulist(items):
+        unique = {}
+        for item in items:
+            unique.setdefault(item["id"], item)
+        return list(unique.values())
+
+    # 比较快照和新列表，返回新增、修改、删除的条目ID（增量下载无法发现删除）
+    @staticmethod
+    def diff_ulist(old_items, new_list):
+        new_items = {item["id"]: item for item in new_list}
+        return {
+            "added": [i for i in new_items if i not in old_items],
+            "changed": [i for i in new_items if i in old_items and new_items[i]["lastmod"] != old_items[i]["lastmod"]],
+            "removed": [i for i in old_items if i not in new_items]
+        }
+
+    # 加载上次下载的列表快照
+    def load_ulist_snapshot(self):
+        if os.path.exists(self.ulist_snapshot_path):
+            with open(self.ulist_snapshot_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        return None
+
+    # 保存列表快照，条目按ID索引，high_water 为最大的 lastmod
+    def save_ulist_snapshot(self, fields, items):
+        snapshot = {
+            "userid": self.userid,
+            "fields": fields,
+            "high_water": max((item["lastmod"] for item in items), default=0),
+            "items": {item["id"]: item for item in items}
+        }
+        with open(self.ulist_snapshot_path, 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file, ensure_ascii=False)
 
     # 上传游戏数据
     def upload_game(self, vid, labels_set, vote=None, finished=None):
@@ -148,38 +876,81 @@ class VNDBSync:
             data["vote"] = vote
         if finished:
             data["finished"] = finished
-        saferequestvndb(self.proxy, "PATCH", f"ulist/v{vid}", json=data, headers=self.headers)
+        with tracer.span(f"PATCH ulist/v{vid}", "upload"):
+            saferequestvndb(self.proxy, "PATCH", f"ulist/v{vid}", json=data, headers=self.headers)
 
     # 下载游戏列表
     def download_game_list(self):
-        return self.querylist(True)
+        return self.querylist(True, self.incremental_download)
 
     # 上传游戏列表
-    def upload_game_list(self, game_data):
+    # 线程数默认取并发上限的最大值，实际同时进行的请求数由 concurrency 控制
+    def upload_game_list(self, game_data, max_workers=concurrency.maximum):
         failed_uploads = []
-        
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_game = {executor.submit(self.upload_single_game, game, i): game for i, game in enumerate(game_data[self.current_index:], start=self.current_index)}
-            
-            for future in tqdm(as_completed(future_to_game), total=len(future_to_game), desc="上传游戏数据"):
-                game = future_to_game[future]
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"记录失败的上传 '{game[0]}': {e}") 
-                    failed_uploads.append(game)
-                    self.save_failed_uploads([game])
-        
+        queue, skipped = SyncScheduler.prioritize(game_data, self.synced, self.load_failed_fingerprints())
+        print(f"{skipped} 条未变化已跳过，待同步 {len(queue)} 条")
+        scheduler = SyncScheduler(run_deadline())
+        if scheduler.deadline is not None:
+            print(f"预计可在时间预算内同步约 {min(len(queue), scheduler.predicted_capacity())} 条")
+
+        pending = iter(queue)
+        futures = {}
+        out_of_time = 0
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(total=len(queue), desc="上传游戏数据") as progress:
+                def submit_next():
+                    while len(futures) < max_workers and scheduler.should_continue(len(futures)):
+                        game = next(pending, None)
+                        if game is None:
+                            return
+                        futures[executor.submit(self.upload_single_game, game)] = game
+
+                submit_next()
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        game = futures.pop(future)
+                        progress.update()
+                        try:
+                            future.result()
+                        except RunBudgetExceeded:
+                            # 只是运行时间用完，不算失败，也不计入请求速率的统计，下次运行按原优先级重试
+                            out_of_time += 1
+                            continue
+                        except Exception as e:
+                            print(f"记录失败的上传 '{game[0]}': {e}") 
+                            failed_uploads.append(game)
+                            self.save_failed_uploads([game])
+                        scheduler.entry_done()
+                    # 运行预算耗尽后不再提交新条目
+                    if not out_of_time:
+                        submit_next()
+        finally:
+            self.mapping.flush()
+            self.flush_progress()
+
+        remaining = len(queue) - scheduler.entries_done
+        if remaining:
+            print(f"即将超出时间预算，提前停止，剩余 {remaining} 条留待下次运行")
         return failed_uploads
 
-    def upload_single_game(self, game, index):
-        title, title_cn, labels_set, vote, finished = game
-        vid = getidbytitle_(self.proxy, title, title_cn)
+    def upload_single_game(self, game):
+        title = game[0]
+        with tracer.entry(title):
+            self.sync_single_game(game)
+
+    def sync_single_game(self, game):
+        title, title_cn, labels_set, vote, finished, subject_id = game
+        vid = self.mapping.get(subject_id)
+        if not vid:
+            vid = getidbytitle_(self.proxy, title, title_cn)
         if vid:
             try:
                 self.upload_game(int(vid[1:]), labels_set, vote, finished)
-                self.current_index = index + 1
-                self.save_progress()
+                self.mapping.add(subject_id, vid)
+                self.mark_synced(game)
+            except RunBudgetExceeded:
+                raise
             except Exception as e:
                 print(f"记录失败的上传 '{title}': {e}") 
                 self.save_failed_uploads([game])
@@ -187,39 +958,154 @@ class VNDBSync:
             print(f"找不到ID '{title}'") 
             self.save_failed_uploads([game])
 
+    # 记录条目已同步的内容，同时从失败记录中移除该条目，攒够 progress_save_every 条再写回文件
+    def mark_synced(self, game):
+        key = game_key(game)
+        with self.file_lock:
+            self.synced[key] = game_fingerprint(game)
+            if self.failed.pop(key, None) is not None:
+                self.failed_changed = True
+            self.unsaved_progress += 1
+            if self.unsaved_progress >= progress_save_every:
+                self.write_progress()
+
+    # 写回尚未保存的进度和失败记录的变化
+    def flush_progress(self):
+        with self.file_lock:
+            if self.unsaved_progress:
+                self.write_progress()
+
+    def write_progress(self):
+        self.save_progress()
+        self.unsaved_progress = 0
+        if self.failed_changed:
+            self.write_failed_uploads(self.failed)
+            self.failed_changed = False
+
     # 保存进度
+    # 分片运行时只写入本分片新同步或有变化的条目，共享进度中已有的条目留给合并步骤
     def save_progress(self):
+        synced = {key: value for key, value in self.synced.items() if self.base_synced.get(key) != value}
         with open(self.progress_file, 'w', encoding='utf-8') as file:
-            json.dump({"current_index": self.current_index}, file)
+            json.dump({"synced": synced}, file, ensure_ascii=False)
+
+    # 旧版进度只记录了 {"current_index": N}，表示本地数据中前 N 条已同步
+    # 迁移时把这些条目按当前内容记为已同步，分片运行时只迁移本分片的条目
+    def migrate_legacy_progress(self, game_data):
+        if not os.path.exists(self.base_progress_file):
+            return 0
+        with open(self.base_progress_file, 'r', encoding='utf-8') as file:
+            current_index = json.load(file).get("current_index")
+        if not current_index:
+            return 0
+        migrated = [game for game in game_data[:current_index]
+                    if self.shard_count <= 1 or shard_of(game, self.shard_count) == self.shard_index]
+        with self.file_lock:
+            for game in migrated:
+                self.synced.setdefault(game_key(game), game_fingerprint(game))
+            self.save_progress()
+        print(f"从旧版进度迁移了 {len(migrated)} 条已同步记录")
+        return len(migrated)
 
-    # 加载进度
+    # 加载进度，返回已同步条目的键到内容指纹的映射
     def load_progress(self):
-        if os.path.exists(self.progress_file):
-            with open(self.progress_file, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-                return data.get("current_index", 0)
-        return 0
+        synced = dict(self.base_synced)
+        synced.update(self.read_synced(self.progress_file))
+        return synced
+
+    @staticmethod
+    def read_synced(path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file).get("synced", {})
+
+    # 之前失败过的条目的键到失败时内容指纹的映射
+    def load_failed_fingerprints(self):
+        entries = self.read_failed_uploads(self.base_failed_uploads_path) if self.shard_count > 1 else {}
+        entries.update(self.failed)
+        return {key: game_fingerprint(failed_entry_to_game(entry)) for key, entry in entries.items()}
+
+    # 读取失败记录，按条目键去重，后记录的覆盖先记录的
+    @staticmethod
+    def read_failed_uploads(path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as file:
+            return {game_key(failed_entry_to_game(entry)): entry for entry in json.load(file)["data"]}
 
     # 保存失败的上传
     def save_failed_uploads(self, failed_uploads):
-        if os.path.exists(self.failed_uploads_path):
-            with open(self.failed_uploads_path, 'r', encoding='utf-8') as file:
-                existing_data = json.load(file)
-        else:
-            existing_data = {"data": []}
-        
-        for game in failed_uploads:
-            entry = {
-                "title": game[0],
-                "title_cn": game[1],
-                "labels_set": game[2],
-                "vote": game[3],
-                "finished": game[4]
-            }
-            existing_data["data"].append(entry)
-        
+        with self.file_lock:
+            for game in failed_uploads:
+                self.failed[game_key(game)] = {
+                    "title": game[0],
+                    "title_cn": game[1],
+                    "labels_set": game[2],
+                    "vote": game[3],
+                    "finished": game[4],
+                    "subject_id": game[5]
+                }
+            self.write_failed_uploads(self.failed)
+            self.failed_changed = False
+
+    def write_failed_uploads(self, failed):
         with open(self.failed_uploads_path, 'w', encoding='utf-8') as file:
-            json.dump(existing_data, file, ensure_ascii=False, indent=4)
+            json.dump({"data": list(failed.values())}, file, ensure_ascii=False, indent=4)
+
+# 合并各分片的进度、失败记录和映射表，并生成汇总报告
+def merge_shards(base_dir, shard_count):
+    progress_path = os.path.join(base_dir, "progress.json")
+    failed_path = os.path.join(base_dir, "failed_uploads.json")
+    mapping_path = os.path.join(base_dir, "subject_mapping.json")
+    report_path = os.path.join(base_dir, "shard_report.json")
+
+    def load(path, default):
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        return default
+
+    synced = load(progress_path, {}).get("synced", {})
+    base_synced = dict(synced)
+    failed = {game_key(failed_entry_to_game(entry)): entry for entry in load(failed_path, {"data": []})["data"]}
+    mapping = load(mapping_path, {})
+    report = {"shard_count": shard_count, "shards": [], "missing": []}
+
+    for shard_index in range(shard_count):
+        shard_progress = shard_path(progress_path, shard_index, shard_count)
+        if not os.path.exists(shard_progress):
+            report["missing"].append(shard_index)
+        shard_synced = load(shard_progress, {}).get("synced", {})
+        shard_failed = load(shard_path(failed_path, shard_index, shard_count), {"data": []})["data"]
+        synced.update(shard_synced)
+        failed.update((game_key(failed_entry_to_game(entry)), entry) for entry in shard_failed)
+        mapping.update(load(shard_path(mapping_path, shard_index, shard_count), {}))
+        # 只统计本分片新同步或有变化的条目
+        shard_new = sum(1 for key, value in shard_synced.items() if base_synced.get(key) != value)
+        report["shards"].append({"shard": shard_index, "synced": shard_new, "failed": len(shard_failed)})
+
+    # 失败后又以相同内容同步成功的条目不再算作失败
+    failed = [entry for key, entry in failed.items() if synced.get(key) != game_fingerprint(failed_entry_to_game(entry))]
+    report["synced"] = len(synced)
+    report["failed"] = len(failed)
+    report["failed_titles"] = [entry["title"] for entry in failed]
+
+    with open(progress_path, 'w', encoding='utf-8') as file:
+        json.dump({"synced": synced}, file, ensure_ascii=False)
+    with open(failed_path, 'w', encoding='utf-8') as file:
+        json.dump({"data": failed}, file, ensure_ascii=False, indent=4)
+    with open(mapping_path, 'w', encoding='utf-8') as file:
+        json.dump(mapping, file, ensure_ascii=False, indent=4, sort_keys=True)
+    with open(report_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=4)
+
+    for shard in report["shards"]:
+        print(f"分片 {shard['shard']}: 同步 {shard['synced']} 条，失败 {shard['failed']} 条")
+    if report["missing"]:
+        print(f"缺少分片的进度文件: {report['missing']}")
+    print(f"合并后共同步 {report['synced']} 条，失败 {report['failed']} 条，报告保存到: {report_path}")
+    return report
 
 # 读取本地游戏数据
 def read_local_game_data(file_path):
@@ -240,7 +1126,8 @@ def read_local_game_data(file_path):
                     vote = int(item["rate"]) * 10 if item["rate"] != 0 else None
                     status_map = {1: [5], 2: [2], 3: [1], 4: [3], 5: [4]}
                     labels_set = status_map.get(item["type"], [])
-                    game_data.append((title, title_cn, labels_set, vote, finished))
+                    subject_id = item.get("subject_id")
+                    game_data.append((title, title_cn, labels_set, vote, finished, subject_id))
     
     print(f"读取了 {len(game_data)} 条本地游戏数据来自 {file_path}") 
     return game_data
@@ -248,6 +1135,11 @@ def read_local_game_data(file_path):
 # 主函数
 if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    shards_to_merge = int(os.getenv("MERGE_SHARDS", "0"))
+    if shards_to_merge:
+        merge_shards(script_dir, shards_to_merge)
+        raise SystemExit
     
     local_game_data_path = os.path.join(script_dir, "collection_list.json")
 
@@ -258,12 +1150,29 @@ if __name__ == "__main__":
     
     game_data = read_local_game_data(local_game_data_path)
     print(f"读取了 {len(game_data)} 条本地游戏数据")  
+    sync.migrate_legacy_progress(game_data)
+
+    if sync.shard_count > 1:
+        game_data = select_shard(game_data, sync.shard_index, sync.shard_count)
+        print(f"分片 {sync.shard_index}/{sync.shard_count}: 处理 {len(game_data)} 条")
+
+    if sync.trace_file:
+        tracer.enable()
 
     if sync.sync_local:
         failed_uploads = sync.upload_game_list(game_data)
         if failed_uploads:
-            sync.save_failed_uploads(failed_uploads)
             print(f"失败的上传保存到: {sync.failed_uploads_path}") 
+
+    if sync.sync_local:
+        concurrency.report()
+        search_coalescer.report()
+
+    if sync.mapping.hits:
+        print(f"映射表命中 {sync.mapping.hits} 条，跳过了标题搜索")
+
+    if sync.trace_file:
+        tracer.save(sync.trace_file)
     
     if sync.download_vndb:
         downloaded_list = sync.download_game_list()
@@ -1,12 +1,180 @@
 import requests
 import json
 import os
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # 配置 Bangumi API 端点和访问令牌
 BGM_API_URL = "https://api.bgm.tv/v0"
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
 }
+MAX_WORKERS = 4  # 并发获取条目详情的线程数
+REQUESTS_PER_SECOND = 4  # 所有线程合计的请求速率上限
+
+# 重试设置：指数退避加随机抖动，优先遵循 Retry-After
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+REQUEST_TIMEOUT = 30  # 单次HTTP请求的超时时间，单位为秒
+REQUEST_BUDGET_SECONDS = 180  # 单个请求（含所有重试）的时间预算
+RUN_BUDGET_SECONDS = float(os.getenv("RUN_BUDGET_SECONDS", "0"))  # 整次运行的时间预算，0 表示不限制
+RUN_START_TIME = time.time()
+
+# 超出时间预算时抛出的异常
+class RetryBudgetExceeded(Exception):
+    pass
+
+# 熔断器：连续失败过多时暂停所有请求，冷却后只放行一个探测请求
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30, max_cooldown=600):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+        self.probing = False
+        self.condition = threading.Condition()
+
+    # 请求前调用，熔断打开时阻塞直到冷却结束或超出截止时间；返回本次请求是否为半开探测
+    def before_request(self, deadline=None):
+        with self.condition:
+            while True:
+                now = time.time()
+                if now >= self.open_until and self.failures < self.failure_threshold:
+                    return False
+                if now >= self.open_until and not self.probing:
+                    self.probing = True
+                    return True
+                wait = self.open_until - now if now < self.open_until else 1
+                if deadline is not None and now + wait > deadline:
+                    raise RetryBudgetExceeded("熔断器打开，等待会超出时间预算")
+                self.condition.wait(wait)
+
+    def record_success(self):
+        with self.condition:
+            self.failures = 0
+            self.trips = 0
+            self.probing = False
+            self.condition.notify_all()
+
+    def record_failure(self):
+        with self.condition:
+            now = time.time()
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold and now >= self.open_until:
+                self.trips += 1
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** (self.trips - 1))
+                self.open_until = now + cooldown
+                print(f"连续失败 {self.failures} 次，熔断 {cooldown:.0f} 秒，暂停所有请求")
+            self.condition.notify_all()
+
+    # 探测请求因时间预算中止时，既不算成功也不算失败，只交还探测名额
+    def release_probe(self):
+        with self.condition:
+            self.probing = False
+            self.condition.notify_all()
+
+    # 服务端要求等待（Retry-After）时让所有请求一起暂停
+    def pause(self, seconds):
+        with self.condition:
+            self.open_until = max(self.open_until, time.time() + seconds)
+            self.condition.notify_all()
+
+CIRCUIT_BREAKER = CircuitBreaker()
+
+# 解析 Retry-After 头，支持秒数和HTTP日期两种格式
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# 统一的重试层：send(timeout) 发送一次请求并返回响应
+def request_with_retry(send, breaker=CIRCUIT_BREAKER, description=""):
+    deadline = time.time() + REQUEST_BUDGET_SECONDS
+    if RUN_BUDGET_SECONDS > 0:
+        deadline = min(deadline, RUN_START_TIME + RUN_BUDGET_SECONDS)
+        if time.time() >= deadline:
+            raise RetryBudgetExceeded("已超出本次运行的时间预算")
+
+    attempt = 0
+    while True:
+        probe = breaker.before_request(deadline)
+        attempt += 1
+        resp, error = None, None
+        try:
+            resp = send(max(1, min(REQUEST_TIMEOUT, deadline - time.time())))
+        except requests.exceptions.RequestException as e:
+            error = e
+        except RetryBudgetExceeded:
+            # 请求还没发出就因时间预算中止，不是服务端的问题，不计入熔断
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        if resp is not None and resp.status_code not in RETRY_STATUS_CODES:
+            breaker.record_success()
+            return resp
+        breaker.record_failure()
+
+        retry_after = parse_retry_after(resp.headers.get("Retry-After")) if resp is not None else None
+        if retry_after is not None:
+            delay = retry_after
+            breaker.pause(retry_after)
+        else:
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+        reason = f"HTTP {resp.status_code}" if resp is not None else f"{type(error).__name__}: {error}"
+        if attempt >= MAX_ATTEMPTS or time.time() + delay > deadline:
+            print(f"放弃请求 {description}（{reason}），已尝试 {attempt} 次")
+            if resp is not None:
+                return resp
+            raise error
+        print(f"请求失败 {description}（{reason}），{delay:.1f} 秒后进行第 {attempt + 1} 次尝试")
+        time.sleep(delay)
+
+# 所有线程共用的连接池
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=0))
+
+RATE_LIMIT_LOCK = threading.Lock()
+next_request_time = 0
+
+# 按 REQUESTS_PER_SECOND 均匀分配请求时间
+def wait_for_rate_limit():
+    global next_request_time
+    with RATE_LIMIT_LOCK:
+        now = time.time()
+        wait = next_request_time - now
+        next_request_time = max(now, next_request_time) + 1 / REQUESTS_PER_SECOND
+    if wait > 0:
+        time.sleep(wait)
+
+def get_json(url, headers, params=None):
+    def send(timeout):
+        wait_for_rate_limit()
+        return SESSION.get(url, params=params, headers=headers, timeout=timeout)
+
+    response = request_with_retry(send, description=url)
+    response.raise_for_status()
+    return response.json()
 
 def get_headers(access_token):
     headers = HEADERS.copy()
@@ -14,9 +182,7 @@ def get_headers(access_token):
     return headers
 
 def fetch_username(headers):
-    response = requests.get(f"{BGM_API_URL}/me", headers=headers)
-    response.raise_for_status()
-    return response.json()["username"]
+    return get_json(f"{BGM_API_URL}/me", headers)["username"]
 
 def fetch_collections(username, headers):
     params = {
@@ -24,14 +190,27 @@ def fetch_collections(username, headers):
         "limit": "50",
         "offset": "0",
     }
-    response = requests.get(f"{BGM_API_URL}/users/{username}/collections", params=params, headers=headers)
-    response.raise_for_status()
-    return response.json()["data"]
+    return get_json(f"{BGM_API_URL}/users/{username}/collections", headers, params)["data"]
 
 def fetch_detailed_info(subject_id, headers):
-    response = requests.get(f"{BGM_API_URL}/subjects/{subject_id}", headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return get_json(f"{BGM_API_URL}/subjects/{subject_id}", headers)
+
+# 并发获取去重后的条目详情，返回 (详情, 失败记录)，单个条目失败不影响其他条目
+def fetch_all_detailed_info(subject_ids, headers):
+    subject_ids = list(dict.fromkeys(subject_ids))
+    details = {}
+    failures = {}
+
+    def fetch(subject_id):
+        try:
+            details[subject_id] = fetch_detailed_info(subject_id, headers)
+        except Exception as e:
+            print(f"获取条目 {subject_id} 详情失败: {e}")
+            failures[subject_id] = str(e)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(fetch, subject_ids))
+    return details, failures
 
 def main():
     access_token = os.getenv("BGM_ACCESS_TOKEN")
@@ -41,11 +220,13 @@ def main():
     headers = get_headers(access_token)
     username = fetch_username(headers)
     collections = fetch_collections(username, headers)
+    details, failures = fetch_all_detailed_info([item["subject_id"] for item in collections], headers)
     detailed_collections = []
 
     for item in collections:
         subject_id = item["subject_id"]
-        detailed_info = fetch_detailed_info(subject_id, headers)
+        # 获取详情失败时退回收藏列表自带的简略条目信息
+        detailed_info = details.get(subject_id, item.get("subject"))
         detailed_collections.append({
             "updated_at": item["updated_at"],
             "comment": item["comment"],
@@ -61,6 +242,9 @@ def main():
         })
 
     output = {"data": detailed_collections}
+    if failures:
+        output["failed"] = [{"subject_id": subject_id, "error": error} for subject_id, error in failures.items()]
+        print(f"{len(failures)} 个条目详情获取失败，已使用简略信息")
     
     with open("collection_list.json", "w", encoding="utf-8") as f:
         json.dump(output, f, ensure_ascii=False, indent=4)
@@ -4,6 +4,9 @@ import json
 import time
 import logging
 import os
+import random
+import threading
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 import requests
 from tqdm import tqdm
@@ -16,6 +19,142 @@ LOAD_WAIT_MS = 1000  # 请求之间的等待时间，单位为毫秒
 ACCESS_TOKEN = os.getenv("BGM_ACCESS_TOKEN")  # 从环境变量中获取访问令牌
 USERNAME = os.getenv("BGM_USERNAME")  # 存储用户名
 
+# 重试设置：指数退避加随机抖动，优先遵循 Retry-After
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 6
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+REQUEST_TIMEOUT = 30  # 单次HTTP请求的超时时间，单位为秒
+REQUEST_BUDGET_SECONDS = 180  # 单个请求（含所有重试）的时间预算
+RUN_BUDGET_SECONDS = float(os.getenv("RUN_BUDGET_SECONDS", "0"))  # 整次运行的时间预算，0 表示不限制
+RUN_START_TIME = time.time()
+
+# 超出时间预算时抛出的异常
+class RetryBudgetExceeded(Exception):
+    pass
+
+# 熔断器：连续失败过多时暂停所有请求，冷却后只放行一个探测请求
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30, max_cooldown=600):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+        self.probing = False
+        self.condition = threading.Condition()
+
+    # 请求前调用，熔断打开时阻塞直到冷却结束或超出截止时间；返回本次请求是否为半开探测
+    def before_request(self, deadline=None):
+        with self.condition:
+            while True:
+                now = time.time()
+                if now >= self.open_until and self.failures < self.failure_threshold:
+                    return False
+                if now >= self.open_until and not self.probing:
+                    self.probing = True
+                    return True
+                wait = self.open_until - now if now < self.open_until else 1
+                if deadline is not None and now + wait > deadline:
+                    raise RetryBudgetExceeded("熔断器打开，等待会超出时间预算")
+                self.condition.wait(wait)
+
+    def record_success(self):
+        with self.condition:
+            self.failures = 0
+            self.trips = 0
+            self.probing = False
+            self.condition.notify_all()
+
+    def record_failure(self):
+        with self.condition:
+            now = time.time()
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold and now >= self.open_until:
+                self.trips += 1
+                cooldown = min(self.max_cooldown, self.cooldown * 2 ** (self.trips - 1))
+                self.open_until = now + cooldown
+                logging.warning(f"连续失败 {self.failures} 次，熔断 {cooldown:.0f} 秒，暂停所有请求")
+            self.condition.notify_all()
+
+    # 探测请求因时间预算中止时，既不算成功也不算失败，只交还探测名额
+    def release_probe(self):
+        with self.condition:
+            self.probing = False
+            self.condition.notify_all()
+
+    # 服务端要求等待（Retry-After）时让所有请求一起暂停
+    def pause(self, seconds):
+        with self.condition:
+            self.open_until = max(self.open_until, time.time() + seconds)
+            self.condition.notify_all()
+
+CIRCUIT_BREAKER = CircuitBreaker()
+
+# 解析 Retry-After 头，支持秒数和HTTP日期两种格式
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# 统一的重试层：send(timeout) 发送一次请求并返回响应
+def request_with_retry(send, breaker=CIRCUIT_BREAKER, description=""):
+    deadline = time.time() + REQUEST_BUDGET_SECONDS
+    if RUN_BUDGET_SECONDS > 0:
+        deadline = min(deadline, RUN_START_TIME + RUN_BUDGET_SECONDS)
+        if time.time() >= deadline:
+            raise RetryBudgetExceeded("已超出本次运行的时间预算")
+
+    attempt = 0
+    while True:
+        probe = breaker.before_request(deadline)
+        attempt += 1
+        resp, error = None, None
+        try:
+            resp = send(max(1, min(REQUEST_TIMEOUT, deadline - time.time())))
+        except requests.exceptions.RequestException as e:
+            error = e
+        except RetryBudgetExceeded:
+            # 请求还没发出就因时间预算中止，不是服务端的问题，不计入熔断
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        if resp is not None and resp.status_code not in RETRY_STATUS_CODES:
+            breaker.record_success()
+            return resp
+        breaker.record_failure()
+
+        retry_after = parse_retry_after(resp.headers.get("Retry-After")) if resp is not None else None
+        if retry_after is not None:
+            delay = retry_after
+            breaker.pause(retry_after)
+        else:
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1)))
+
+        reason = f"HTTP {resp.status_code}" if resp is not None else f"{type(error).__name__}: {error}"
+        if attempt >= MAX_ATTEMPTS or time.time() + delay > deadline:
+            logging.error(f"放弃请求 {description}（{reason}），已尝试 {attempt} 次")
+            if resp is not None:
+                return resp
+            raise error
+        logging.warning(f"请求失败 {description}（{reason}），{delay:.1f} 秒后进行第 {attempt + 1} 次尝试")
+        time.sleep(delay)
+
+SESSION = requests.Session()
+
 # 使用Bearer令牌进行API请求，返回JSON响应
 def get_json_with_bearer_token(url):
     time.sleep(LOAD_WAIT_MS / 1000)  # 等待指定的毫秒数
@@ -25,7 +164,7 @@ def get_json_with_bearer_token(url):
         'accept': 'application/json',
         'User-Agent': 'bangumi-takeout-python/v1'
     }
-    response = requests.get(url, headers=headers)
+    response = request_with_retry(lambda timeout: SESSION.get(url, headers=headers, timeout=timeout), description=url)
     response.raise_for_status()
     return response.json()
 